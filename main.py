@@ -6,6 +6,21 @@ import tomllib
 from pathlib import Path
 from pprint import pprint
 import io
+import os
+import sys
+import mmap
+import zlib
+import struct
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 
 # ----------------------------------------------------------
@@ -36,8 +51,54 @@ IGNORED_MODS = {
 }
 
 
-def should_ignore(modid: str) -> bool:
-    return modid and modid.lower() in IGNORED_MODS
+@functools.cache
+def mod_key(modid: str) -> str:
+    # Case-folded, interned form of a mod id; popular ids are normalized once
+    return sys.intern(modid.lower())
+
+
+_IGNORED_LC = frozenset(mod_key(m) for m in IGNORED_MODS)
+
+
+def drop_ignored(depends: dict) -> dict:
+    for d in [d for d in depends if d and mod_key(d) in _IGNORED_LC]:
+        del depends[d]
+    return depends
+
+
+# ----------------------------------------------------------
+#  Errors a broken jar or metadata file can raise
+# ----------------------------------------------------------
+
+class MetadataError(ValueError):
+    """Metadata parsed fine but does not have the expected shape."""
+
+
+def expect_type(value, kind, what):
+    if not isinstance(value, kind):
+        raise MetadataError(f"{what} has unexpected type {type(value).__name__}")
+    return value
+
+
+# Corrupt archives, truncated or corrupt entries, unsupported compression
+ZIP_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError)
+
+METADATA_ERRORS = ZIP_ERRORS + (
+    json.JSONDecodeError,
+    tomllib.TOMLDecodeError,
+    UnicodeDecodeError,
+    MetadataError,
+)
+
+
+def load_json(raw: bytes):
+    # orjson is much faster but stricter (no BOM, no NaN), so fall back to json
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
 
 
 # ----------------------------------------------------------
@@ -48,237 +109,328 @@ def should_ignore(modid: str) -> bool:
 def extract_metadata_from_bytes(raw_bytes):
     try:
         jar = zipfile.ZipFile(io.BytesIO(raw_bytes))
-    except Exception:
+    except ZIP_ERRORS:
         return None
 
+    with jar:
+        return extract_metadata_from_zip(jar)
+
+
+# ----------------------------------------------------------
+#  Extract metadata from an open jar
+#  (Shared by mod jars and nested jars)
+# ----------------------------------------------------------
+
+def extract_metadata_from_zip(jar, names=None):
+    if names is None:
+        names = frozenset(jar.namelist())
+
     # ---- Fabric ----
-    if "fabric.mod.json" in jar.namelist():
+    if "fabric.mod.json" in names:
         try:
-            with jar.open("fabric.mod.json") as f:
-                data = json.load(f)
+            data = expect_type(load_json(jar.read("fabric.mod.json")), dict, "fabric.mod.json")
 
-            mod_id = data.get("id")
+            mod_id = expect_type(data.get("id"), (str, type(None)), "id")
             name = data.get("name") or mod_id
             depends = {}
 
-            for dep in data.get("depends", {}).keys():
+            for dep in expect_type(data.get("depends", {}), dict, "depends").keys():
                 depends[dep] = {"required": True}
-            for dep in data.get("recommends", {}).keys():
+            for dep in expect_type(data.get("recommends", {}), dict, "recommends").keys():
                 depends[dep] = {"required": False}
-            for dep in data.get("suggests", {}).keys():
+            for dep in expect_type(data.get("suggests", {}), dict, "suggests").keys():
                 depends[dep] = {"required": False}
 
-            return {"id": mod_id, "name": name, "depends": depends}
+            jar_ids = []
+            jars = data.get("jars", [])
+            for entry in jars if isinstance(jars, list) else []:
+                if isinstance(entry, dict) and isinstance(entry.get("id"), str):
+                    jar_ids.append(mod_key(entry["id"]))
+
+            return {"id": mod_id, "name": name, "depends": depends, "_fabric_jar_ids": jar_ids}
 
-        except:
+        except METADATA_ERRORS:
             pass
 
     # ---- Forge modern ----
-    if "META-INF/mods.toml" in jar.namelist():
+    if "META-INF/mods.toml" in names:
         try:
             with jar.open("META-INF/mods.toml") as f:
-                data = tomllib.loads(f.read().decode("utf-8"))
+                data = tomllib.load(f)
 
-            mod_entry = data.get("mods", [])
+            mod_entry = expect_type(data.get("mods", []), list, "mods")
             if not mod_entry:
                 return None
 
-            mod_id = mod_entry[0].get("modId")
-            name = mod_entry[0].get("displayName") or mod_id
+            first = expect_type(mod_entry[0], dict, "mods[0]")
+            mod_id = expect_type(first.get("modId"), (str, type(None)), "modId")
+            name = first.get("displayName") or mod_id
             depends = {}
 
-            depArr = data.get("dependencies", {}).get(mod_id, [])
+            dependencies = expect_type(data.get("dependencies", {}), dict, "dependencies")
+            depArr = expect_type(dependencies.get(mod_id, []), list, "dependencies")
             for dep in depArr:
-                dep_id = dep.get("modId")
+                dep = expect_type(dep, dict, "dependency")
+                dep_id = expect_type(dep.get("modId"), (str, type(None)), "dependency modId")
                 required = dep.get("mandatory", False)
                 depends[dep_id] = {"required": required}
 
             return {"id": mod_id, "name": name, "depends": depends}
-        except:
+        except METADATA_ERRORS:
             pass
 
     # ---- Forge old (mcmod.info) ----
-    if "mcmod.info" in jar.namelist():
+    if "mcmod.info" in names:
         try:
-            with jar.open("mcmod.info") as f:
-                data = json.load(f)
+            data = load_json(jar.read("mcmod.info"))
             if isinstance(data, list) and data:
-                entry = data[0]
-                mod_id = entry.get("modid")
+                entry = expect_type(data[0], dict, "mcmod.info entry")
+                mod_id = expect_type(entry.get("modid"), (str, type(None)), "modid")
                 name = entry.get("name") or mod_id
                 depends = {}
-                for dep in entry.get("dependencies", []):
-                    depends[dep] = {"required": True}
-                for dep in entry.get("requiredMods", []):
-                    depends[dep] = {"required": True}
+                for dep in expect_type(entry.get("dependencies", []), list, "dependencies"):
+                    depends[expect_type(dep, str, "dependency")] = {"required": True}
+                for dep in expect_type(entry.get("requiredMods", []), list, "requiredMods"):
+                    depends[expect_type(dep, str, "requiredMods entry")] = {"required": True}
                 return {"id": mod_id, "name": name, "depends": depends}
-        except:
+        except METADATA_ERRORS:
             pass
 
     return None
 
 
 # ----------------------------------------------------------
-#  Detect whether a dependency is embedded inside a .jar
+#  Open a jar nested inside an outer jar
+#  (STORED entries are read in place instead of being copied out)
 # ----------------------------------------------------------
 
-def is_dependency_embedded(jar_path, dep_id):
-    dep = dep_id.lower()
+# Fixed part of a zip local file header (APPNOTE.TXT 4.3.7)
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+LOCAL_HEADER_SIZE = 30
+
+# Smallest possible end of central directory record (APPNOTE.TXT 4.3.16)
+EOCD_MIN_SIZE = 22
+
+
+class _ZipSlice(io.RawIOBase):
+    """Read-only, seekable view of ``size`` bytes of ``fp`` starting at ``offset``."""
+
+    def __init__(self, fp, offset, size, owns_fp=False):
+        self._fp = fp
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+        self._owns_fp = owns_fp
+
+    def close(self):
+        if self._owns_fp and not self.closed:
+            self._fp.close()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        self._pos = max(0, pos)
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), self._size - self._pos)
+        if n <= 0:
+            return 0
+        self._fp.seek(self._offset + self._pos)
+        data = self._fp.read(n)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
 
+def _open_nested_jar(outer_fp, outer_zip, name):
+    info = outer_zip.getinfo(name)
+
+    if info.compress_type == zipfile.ZIP_STORED:
+        # Skip the local file header to reach the raw bytes of the nested jar
+        outer_fp.seek(info.header_offset)
+        header = outer_fp.read(LOCAL_HEADER_SIZE)
+        if header[:4] == LOCAL_HEADER_SIGNATURE:
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            offset = info.header_offset + LOCAL_HEADER_SIZE + name_len + extra_len
+            return zipfile.ZipFile(_ZipSlice(outer_fp, offset, info.compress_size))
+
+    # Compressed entries have to be inflated before the inner zip can be read
+    return zipfile.ZipFile(io.BytesIO(outer_zip.read(name)))
+
+
+def extract_nested_metadata(outer_fp, outer_zip, entry_name):
+    # Like extract_metadata_from_bytes, without copying the nested jar out first
     try:
-        jar = zipfile.ZipFile(jar_path)
-    except Exception:
-        return False
-
-    paths = jar.namelist()
-
-    # --- 1. META-INF/jars/ and jarjar/ embedded jars ---
-    embedded_prefixes = [
-        "META-INF/jars/",
-        "META-INF/jarjar/",
-    ]
-    for prefix in embedded_prefixes:
-        for name in paths:
-            if name.startswith(prefix) and name.endswith(".jar"):
-                try:
-                    raw = jar.read(name)
-                    meta = extract_metadata_from_bytes(raw)
-                    if meta and meta["id"] and meta["id"].lower() == dep:
-                        return True
-                except:
-                    pass
-
-    # --- 2. Namespace folders: assets/dep/, data/dep/ ---
-    namespace_paths = [
-        f"assets/{dep}/",
-        f"data/{dep}/",
-    ]
-    for ns in namespace_paths:
-        if any(p.startswith(ns) for p in paths):
-            return True
-
-    # --- 3. Class packages heuristic ---
-    likely_prefixes = [
-        f"{dep}/",
-        f"com/{dep}/",
-        f"net/{dep}/",
-        f"io/{dep}/",
-    ]
-    for name in paths:
-        n = name.lower()
-        if any(n.startswith(pref) for pref in likely_prefixes):
-            if n.endswith(".class"):
-                return True
-
-    # --- 4. Fabric embedded 'jars' list ---
-    if "fabric.mod.json" in paths:
-        try:
-            data = json.load(jar.open("fabric.mod.json"))
-            for entry in data.get("jars", []):
-                if dep in entry.get("id", "").lower():
-                    return True
-        except:
-            pass
+        jar = _open_nested_jar(outer_fp, outer_zip, entry_name)
+    except ZIP_ERRORS:
+        return None
 
-    return False
+    with jar:
+        return extract_metadata_from_zip(jar)
 
 
 # ----------------------------------------------------------
-#  Extract metadata from a single mod .jar
+#  Map a mod .jar into memory, read-only
+#  (the central directory is paged in instead of read())
 # ----------------------------------------------------------
 
-def extract_mod_metadata(jar_path):
-    try:
-        jar = zipfile.ZipFile(jar_path)
-    except:
-        return None
+def map_jar(jar_path):
+    with open(jar_path, "rb") as f:
+        # Reject junk before mapping: too small for an EOCD record, or no zip magic
+        if os.fstat(f.fileno()).st_size < EOCD_MIN_SIZE:
+            raise zipfile.BadZipFile("file is too small to be a jar")
+        if f.read(4) != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile("file does not start with a zip header")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    # ---------- FABRIC ----------
-    if "fabric.mod.json" in jar.namelist():
-        try:
-            with jar.open("fabric.mod.json") as f:
-                data = json.load(f)
+    # mmap has no seekable() before Python 3.13, which ZipFile needs;
+    # closing the view unmaps the file
+    return _ZipSlice(mm, 0, len(mm), owns_fp=True)
 
-            mod_id = data.get("id")
-            name = data.get("name") or mod_id
 
-            depends = {}
-            for dep in data.get("depends", {}).keys():
-                depends[dep] = {"required": True}
-            for dep in data.get("recommends", {}).keys():
-                depends[dep] = {"required": False}
-            for dep in data.get("suggests", {}).keys():
-                depends[dep] = {"required": False}
+# ----------------------------------------------------------
+#  Collect the mod ids of all jars nested inside an outer jar
+# ----------------------------------------------------------
 
-            return {"id": mod_id, "name": name, "depends": depends, "_path": jar_path}
+def _embedded_mod_ids(outer_fp, outer_zip, embedded_jars):
+    if not embedded_jars:
+        return frozenset()
 
-        except:
-            pass
+    ids = set()
+    for name in embedded_jars:
+        meta = extract_nested_metadata(outer_fp, outer_zip, name)
+        if meta and meta["id"]:
+            ids.add(mod_key(meta["id"]))
 
-    # ---------- FORGE (modern) ----------
-    if "META-INF/mods.toml" in jar.namelist():
-        try:
-            with jar.open("META-INF/mods.toml") as f:
-                data = tomllib.loads(f.read().decode("utf-8"))
+    return frozenset(ids)
 
-            mod_entry = data.get("mods", [])
-            if not mod_entry:
-                return None
 
-            mod_id = mod_entry[0].get("modId")
-            name = mod_entry[0].get("displayName") or mod_id
+# ----------------------------------------------------------
+#  Index every mod id embedded in the scanned jars
+#  Returns (provided_ids, fabric_jar_ids); installed mods are
+#  matched exactly, outside this index
+# ----------------------------------------------------------
+
+def build_provided_index(mods):
+    provided_ids = set()
+    fabric_jar_ids = []
 
-            depends = {}
-            depArr = data.get("dependencies", {}).get(mod_id, [])
-            for dep in depArr:
-                dep_id = dep.get("modId")
-                required = dep.get("mandatory", False)
-                depends[dep_id] = {"required": required}
+    for info in mods.values():
+        # --- 1. Namespace folders: assets/dep/, data/dep/ ---
+        provided_ids.update(info["_namespaces"])
 
-            return {"id": mod_id, "name": name, "depends": depends, "_path": jar_path}
-        except:
-            pass
+        # --- 2. Class packages heuristic: dep/, com/dep/, net/dep/, io/dep/ ---
+        provided_ids.update(info["_class_roots"])
 
-    # ---------- FORGE old ----------
-    if "mcmod.info" in jar.namelist():
-        try:
-            with jar.open("mcmod.info") as f:
-                data = json.load(f)
-            if isinstance(data, list) and data:
-                entry = data[0]
-                mod_id = entry.get("modid")
-                name = entry.get("name") or mod_id
-                depends = {}
-                for dep in entry.get("dependencies", []):
-                    depends[dep] = {"required": True}
-                for dep in entry.get("requiredMods", []):
-                    depends[dep] = {"required": True}
-                return {"id": mod_id, "name": name, "depends": depends, "_path": jar_path}
-        except:
-            pass
+        # --- 3. Fabric embedded 'jars' list (matched by substring, so kept apart) ---
+        fabric_jar_ids.extend(info["_fabric_jar_ids"])
 
-    return None
+        # --- 4. META-INF/jars/ and jarjar/ embedded jars ---
+        provided_ids.update(info["_embedded_ids"])
+
+    return provided_ids, fabric_jar_ids
+
+
+# ----------------------------------------------------------
+#  Extract metadata from a single mod .jar
+# ----------------------------------------------------------
+
+def extract_mod_metadata(jar, jar_path):
+    names = frozenset(jar.namelist())
+    info = extract_metadata_from_zip(jar, names)
+    if not info:
+        return None
+
+    drop_ignored(info["depends"])
+    info["_path"] = jar_path
+    info["_paths_set"] = names
+    info.setdefault("_fabric_jar_ids", [])
+    return info
 
 
 # ----------------------------------------------------------
 #  Scan folder of .jar files
 # ----------------------------------------------------------
 
+def _scan_jar(jar_path):
+    try:
+        fp = map_jar(jar_path)
+    except ZIP_ERRORS as e:
+        logger.debug("skipping %s: %s", jar_path, e)
+        return None
+    except OSError as e:
+        logger.warning("could not read %s: %s", jar_path, e)
+        return None
+
+    # Jars are only open while scanning; large packs would run out of file handles
+    with fp:
+        try:
+            jar = zipfile.ZipFile(fp)
+        except ZIP_ERRORS as e:
+            logger.debug("skipping %s: %s", jar_path, e)
+            return None
+
+        with jar:
+            info = extract_mod_metadata(jar, jar_path)
+            if not info or not info["id"] or mod_key(info["id"]) in _IGNORED_LC:
+                return None
+            _index_jar(info, fp, jar)
+
+    return info
+
+
+def _index_jar(info, fp, jar):
+    # Classify the jar listing for the embedded-dependency checks in one pass
+    embedded_jars = []
+    namespaces = set()
+    class_roots = set()
+    for n in info["_paths_set"]:
+        if n.startswith(("META-INF/jars/", "META-INF/jarjar/")):
+            if n.endswith(".jar"):
+                embedded_jars.append(n)
+        elif n.startswith(("assets/", "data/")):
+            parts = n.split("/", 2)
+            if len(parts) == 3:
+                namespaces.add(parts[1])
+
+        if n.endswith(".class"):
+            parts = n.lower().split("/", 2)
+            if len(parts) > 1:
+                class_roots.add(parts[0])
+            if len(parts) > 2 and parts[0] in ("com", "net", "io"):
+                class_roots.add(parts[1])
+
+    info["_embedded_jars"] = embedded_jars
+    info["_namespaces"] = namespaces
+    info["_class_roots"] = class_roots
+    info["_id_b"] = _enc(info["id"])
+    info["_name_b"] = _enc(info["name"])
+    info["_embedded_ids"] = _embedded_mod_ids(fp, jar, info["_embedded_jars"])
+
+
 def scan_mod_folder(folder):
     folder = Path(folder)
     mods = {}
 
-    for jar in folder.glob("*.jar"):
-        info = extract_mod_metadata(jar)
-        if info and info["id"] and not should_ignore(info["id"]):
-
-            # Filter ignored dependencies
-            info["depends"] = {
-                d: info["depends"][d]
-                for d in info["depends"].keys()
-                if not should_ignore(d)
-            }
+    # Jars are independent, so read them concurrently; mods is only built here
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as ex:
+        results = list(ex.map(_scan_jar, folder.glob("*.jar")))
 
+    for info in results:
+        if info:
             mods[info["id"]] = info
 
     return mods
@@ -288,61 +440,87 @@ def scan_mod_folder(folder):
 #  Export dependency graph to .dot
 # ----------------------------------------------------------
 
-def export_to_dot(mods, output_path):
+DOT_HEADER = (
+    b'digraph mods {\n'
+    b'    rankdir="LR";\n'
+    b'    node [shape=box, style=filled, fillcolor="white"];\n'
+)
+DOT_FOOTER = b"}"
+NODE_TMPL = b'    "%s" [label="%s\\n(%s)", fillcolor="white"];\n'
+EDGE_TMPL = b'    "%s" -> "%s";\n'
+EDGE_RED_TMPL = b'    "%s" -> "%s" [color="red"];\n'
+EDGE_YELLOW_TMPL = b'    "%s" -> "%s" [color="yellow"];\n'
+MISSING_REQUIRED_TMPL = b'    "%s" [label="%s\\n(MISSING REQUIRED)", fillcolor="red", fontcolor="white"];\n'
+MISSING_OPTIONAL_TMPL = b'    "%s" [label="%s\\n(optional missing)", fillcolor="yellow", fontcolor="black"];\n'
+
+
+def _enc(value) -> bytes:
+    return str(value).encode("utf-8")
+
+
+def export_to_dot(mods, output_path, provided_ids=None, fabric_jar_ids=None):
+
+    if provided_ids is None:
+        provided_ids, fabric_jar_ids = build_provided_index(mods)
+    fabric_jar_ids = fabric_jar_ids or []
 
     installed = set(mods.keys())
     missing_required = set()
     missing_optional = set()
 
-    out = [
-        "digraph mods {",
-        '    rankdir="LR";',
-        '    node [shape=box, style=filled, fillcolor="white"];'
-    ]
+    # Dependency ids repeat across mods, so encode each one only once
+    dep_bytes = {}
+
+    buf = bytearray()
+    write = buf.extend
+    write(DOT_HEADER)
 
     # Nodes for installed mods
-    for mod_id, data in mods.items():
-        label = f"{data['name']}\\n({mod_id})"
-        out.append(f'    "{mod_id}" [label="{label}", fillcolor="white"];')
+    for data in mods.values():
+        mid = data["_id_b"]
+        write(NODE_TMPL % (mid, data["_name_b"], mid))
 
     # Edges
     for mod_id, data in mods.items():
+        mid = data["_id_b"]
         for dep, meta in data["depends"].items():
             required = meta["required"]
             dep_missing = dep not in installed
 
-            # NEW: check if any mod bundles/includes this dependency internally
-            if dep_missing:    
-                print("checking if", dep, "is embedded in", mod_id)
-                for embedded_mod in mods.values():
-                    if is_dependency_embedded(embedded_mod["_path"], dep):
-                        dep_missing = False
-                        break
+            # Not installed: check whether any scanned mod bundles it internally
+            if dep_missing:
+                logger.debug("%s (needed by %s) is not installed, checking embedded copies", dep, mod_id)
+                dep_lc = mod_key(dep)
+                dep_missing = dep_lc not in provided_ids and not any(
+                    dep_lc in jar_id for jar_id in fabric_jar_ids
+                )
+
+            d = dep_bytes.get(dep)
+            if d is None:
+                d = dep_bytes[dep] = _enc(dep)
 
             # Now classify based on presence
             if not dep_missing:
-                out.append(f'    "{mod_id}" -> "{dep}";')
+                write(EDGE_TMPL % (mid, d))
             else:
                 if required:
                     missing_required.add(dep)
-                    out.append(f'    "{mod_id}" -> "{dep}" [color="red"];')
+                    write(EDGE_RED_TMPL % (mid, d))
                 else:
                     missing_optional.add(dep)
-                    out.append(f'    "{mod_id}" -> "{dep}" [color="yellow"];')
+                    write(EDGE_YELLOW_TMPL % (mid, d))
 
     # Nodes for missing dependencies
     for dep in sorted(missing_required):
-        out.append(
-            f'    "{dep}" [label="{dep}\\n(MISSING REQUIRED)", fillcolor="red", fontcolor="white"];'
-        )
+        d = dep_bytes[dep]
+        write(MISSING_REQUIRED_TMPL % (d, d))
 
     for dep in sorted(missing_optional):
-        out.append(
-            f'    "{dep}" [label="{dep}\\n(optional missing)", fillcolor="yellow", fontcolor="black"];'
-        )
+        d = dep_bytes[dep]
+        write(MISSING_OPTIONAL_TMPL % (d, d))
 
-    out.append("}")
-    Path(output_path).write_text("\n".join(out), encoding="utf-8")
+    write(DOT_FOOTER)
+    Path(output_path).write_bytes(buf)
 
 
 # ----------------------------------------------------------
@@ -355,8 +533,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a dependency graph for Minecraft mods.")
     parser.add_argument("folder", help="Folder containing .jar mod files")
     parser.add_argument("--output", "-o", default="mods.dot", help="Output DOT file name")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Log embedded-dependency checks")
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(message)s")
 
     print(f"Scanning: {args.folder}")
     mods = scan_mod_folder(args.folder)